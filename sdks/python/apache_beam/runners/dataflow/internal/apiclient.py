@@ -32,7 +32,6 @@ import os
 import pkg_resources
 import re
 import sys
-import tempfile
 import time
 import warnings
 from copy import copy
@@ -583,9 +582,7 @@ class DataflowApplicationClient(object):
 
     resource_stager = _LegacyDataflowStager(self)
     _, resources = resource_stager.create_and_stage_job_resources(
-        options,
-        temp_dir=tempfile.mkdtemp(),
-        staging_location=google_cloud_options.staging_location)
+        options, staging_location=google_cloud_options.staging_location)
     return resources
 
   def stage_file(
@@ -950,6 +947,10 @@ class _LegacyDataflowStager(Stager):
     self._dataflow_application_client = dataflow_application_client
 
   def stage_artifact(self, local_path_to_artifact, artifact_name):
+    if not artifact_name.startswith('gs://'):
+      _LOGGER.info('Staging file locally to %s', artifact_name)
+      self._copy_local_file(local_path_to_artifact, artifact_name)
+      return
     self._dataflow_application_client._gcs_file_copy(
         local_path_to_artifact, artifact_name)
 
@@ -22,7 +22,10 @@
 from __future__ import absolute_import
 
 import logging
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 # patches unittest.TestCase to be python3 compatible
@@ -939,6 +942,32 @@ class UtilTest(unittest.TestCase):
               mock.ANY, "dataflow_graph.json", mock.ANY)
           client.create_job_description.assert_called_once()
 
+  def test_stage_artifact_links_to_local_staging_location(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    from_path = os.path.join(temp_dir, 'from')
+    to_path = os.path.join(temp_dir, 'to')
+    with open(from_path, 'w') as f:
+      f.write('Package content.')
+    client = mock.Mock()
+    stager = apiclient._LegacyDataflowStager(client)
+
+    stager.stage_artifact(from_path, to_path)
+
+    client._gcs_file_copy.assert_not_called()
+    self.assertTrue(os.path.samefile(from_path, to_path))
+    with open(to_path) as f:
+      self.assertEqual('Package content.', f.read())
+
+  def test_stage_artifact_copies_to_gcs_staging_location(self):
+    client = mock.Mock()
+    stager = apiclient._LegacyDataflowStager(client)
+
+    stager.stage_artifact('/tmp/from', 'gs://test-location/staging/to')
+
+    client._gcs_file_copy.assert_called_once_with(
+        '/tmp/from', 'gs://test-location/staging/to')
+
 
 if __name__ == '__main__':
   unittest.main()
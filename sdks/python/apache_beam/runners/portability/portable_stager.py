@@ -23,11 +23,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import hashlib
 import os
 from typing import Iterator
 from typing import List
 
+from apache_beam.io.filesystems import FileSystems
 from apache_beam.portability.api import beam_artifact_api_pb2
 from apache_beam.portability.api import beam_artifact_api_pb2_grpc
 from apache_beam.runners.portability.stager import Stager
@@ -41,8 +43,14 @@ class PortableStager(Stager):
   uploaded.
 
   Note: This class is not thread safe and user of this class should ensure
-  thread safety.
+  thread safety. The exception is stage_job_resources, which uploads up to
+  MAX_CONCURRENT_STAGING artifacts with distinct names at a time: each upload
+  uses its own PutArtifact stream and only appends to the list of staged
+  artifacts.
   """
+
+  MAX_CONCURRENT_STAGING = 8
+
   def __init__(self, artifact_service_channel, staging_session_token):
     """Creates a new Stager to stage file to LegacyArtifactStagingService.
 
@@ -97,6 +105,22 @@ class PortableStager(Stager):
 
     self._artifact_staging_stub.PutArtifact(artifact_request_generator())
 
+  def stage_job_resources(self, resources, staging_location=None):
+    num_staged_before = len(self._artifacts)
+    staged_resources = super(PortableStager, self).stage_job_resources(
+        resources, staging_location)
+    # Concurrent uploads finish in any order. List their artifacts in the
+    # manifest in the order the resources were given. Artifacts sharing a name
+    # are uploaded in that order, so they take its indices in turn.
+    resource_indices = collections.defaultdict(collections.deque)
+    for index, (_, staged_path) in enumerate(resources):
+      resource_indices[FileSystems.join(staging_location,
+                                        staged_path)].append(index)
+    self._artifacts[num_staged_before:] = sorted(
+        self._artifacts[num_staged_before:],
+        key=lambda artifact: resource_indices[artifact.name].popleft())
+    return staged_resources
+
   def commit_manifest(self):
     manifest = beam_artifact_api_pb2.Manifest(artifact=self._artifacts)
     self._artifacts = []
@@ -35,6 +35,7 @@ import grpc
 
 from apache_beam.portability.api import beam_artifact_api_pb2
 from apache_beam.portability.api import beam_artifact_api_pb2_grpc
+from apache_beam.runners.portability import artifact_service
 from apache_beam.runners.portability import portable_stager
 from apache_beam.utils.thread_pool_executor import UnboundedThreadPoolExecutor
 
@@ -50,13 +51,15 @@ class PortableStagerTest(unittest.TestCase):
     if self._remote_dir:
       shutil.rmtree(self._remote_dir)
 
-  def _stage_files(self, files):
+  def _stage_files(self, files, stage_job_resources=False):
     """Utility method to stage files.
 
       Args:
         files: a list of tuples of the form [(local_name, remote_name),...]
           describing the name of the artifacts in local temp folder and desired
           name in staging location.
+        stage_job_resources: whether to stage all files with a single
+          stage_job_resources call instead of one stage_artifact call each.
     """
     server = grpc.server(UnboundedThreadPoolExecutor())
     staging_service = TestLocalFileSystemLegacyArtifactStagingServiceServicer(
@@ -69,10 +72,16 @@ class PortableStagerTest(unittest.TestCase):
         artifact_service_channel=grpc.insecure_channel(
             'localhost:%s' % test_port),
         staging_session_token='token')
-    for from_file, to_file in files:
-      stager.stage_artifact(
-          local_path_to_artifact=os.path.join(self._temp_dir, from_file),
-          artifact_name=to_file)
+    if stage_job_resources:
+      resources = []
+      for from_file, to_file in files:
+        resources.append((os.path.join(self._temp_dir, from_file), to_file))
+      stager.stage_job_resources(resources, staging_location='')
+    else:
+      for from_file, to_file in files:
+        stager.stage_artifact(
+            local_path_to_artifact=os.path.join(self._temp_dir, from_file),
+            artifact_name=to_file)
     stager.commit_manifest()
     return staging_service.manifest.artifact, staging_service.retrieval_tokens
 
@@ -140,6 +149,60 @@ class PortableStagerTest(unittest.TestCase):
                      ].sort())
     self.assertEqual(retrieval_tokens, frozenset(['token']))
 
+  def test_stage_job_resources_keeps_manifest_order(self):
+    # Earlier files are larger, so that later uploads tend to finish first.
+    files = []
+    for i in range(20):
+      from_file = 'test_local_%d.binary' % i
+      with open(os.path.join(self._temp_dir, from_file), 'wb') as f:
+        f.write(b'x' * ((20 - i) << 16))
+      files.append((from_file, 'test_remote_%d.binary' % i))
+
+    copied_files, _ = self._stage_files(files, stage_job_resources=True)
+
+    self.assertEqual(
+        [to_file for _, to_file in files],
+        [staged_file_metadata.name for staged_file_metadata in copied_files])
+
+  def test_stage_job_resources_with_duplicate_names(self):
+    # Environments may stage different files under one name; the last wins.
+    resources = [(b'a', 'big.jar'), (b'b', 'other.jar'), (b'c', 'big.jar'),
+                 (b'd', 'other.jar')]
+    files = []
+    for i, (content, to_file) in enumerate(resources):
+      from_file = os.path.join(self._temp_dir, 'test_local_%d.jar' % i)
+      with open(from_file, 'wb') as f:
+        f.write(content * (4 << 20))
+      files.append((from_file, to_file))
+
+    server = grpc.server(UnboundedThreadPoolExecutor())
+    staging_service = artifact_service.BeamFilesystemArtifactService(
+        self._remote_dir)
+    beam_artifact_api_pb2_grpc.add_LegacyArtifactStagingServiceServicer_to_server(
+        staging_service, server)
+    test_port = server.add_insecure_port('[::]:0')
+    server.start()
+    stager = portable_stager.PortableStager(
+        artifact_service_channel=grpc.insecure_channel(
+            'localhost:%s' % test_port),
+        staging_session_token='token')
+    staged_files = stager.stage_job_resources(files, staging_location='')
+    retrieval_token = stager.commit_manifest()
+    server.stop(None)
+
+    self.assertEqual([to_file for _, to_file in files], staged_files)
+    manifest = staging_service.GetManifest(
+        beam_artifact_api_pb2.GetManifestRequest(
+            retrieval_token=retrieval_token)).manifest
+    self.assertEqual([to_file for _, to_file in files],
+                     [artifact.name for artifact in manifest.artifact])
+    for content, name in [(b'c', 'big.jar'), (b'd', 'other.jar')]:
+      chunks = staging_service.GetArtifact(
+          beam_artifact_api_pb2.LegacyGetArtifactRequest(
+              name=name, retrieval_token=retrieval_token))
+      self.assertEqual(
+          content * (4 << 20), b''.join(chunk.data for chunk in chunks))
+
 
 class TestLocalFileSystemLegacyArtifactStagingServiceServicer(
     beam_artifact_api_pb2_grpc.LegacyArtifactStagingServiceServicer):
@@ -49,19 +49,28 @@ TODO(silviuc): We should allow customizing the exact command for setup build.
 
 from __future__ import absolute_import
 
-import glob
+import collections
+import errno
 import logging
 import os
 import shutil
 import sys
 import tempfile
+from concurrent import futures
+from contextlib import closing
+from typing import DefaultDict
+from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Set
 
 import pkg_resources
+from future.moves.urllib.error import HTTPError
+from future.moves.urllib.request import ProxyHandler
+from future.moves.urllib.request import build_opener
 
 from apache_beam.internal import pickler
-from apache_beam.internal.http_client import get_new_http
+from apache_beam.internal.http_client import DEFAULT_HTTP_TIMEOUT_SECONDS
 from apache_beam.io.filesystems import FileSystems
 from apache_beam.options.pipeline_options import DebugOptions
 from apache_beam.options.pipeline_options import PipelineOptions  # pylint: disable=unused-import
@@ -81,8 +90,19 @@ WORKFLOW_TARBALL_FILE = 'workflow.tar.gz'
 REQUIREMENTS_FILE = 'requirements.txt'
 EXTRA_PACKAGES_FILE = 'extra_packages.txt'
 
+# Size of the buffer used when streaming downloaded artifacts to disk.
+_DOWNLOAD_CHUNK_SIZE = 1 << 17
+
 _LOGGER = logging.getLogger(__name__)
 
+# Installed versions of SDK distributions, keyed by distribution name. Looking
+# up a distribution scans the metadata of every entry on sys.path, so the result
+# is resolved at most once per process.
+_SDK_VERSIONS = {}  # type: Dict[str, str]
+
+# Python executable used to run pip and setup.py, see _get_python_executable.
+_PYTHON_EXECUTABLE = None  # type: Optional[str]
+
 
 def retry_on_non_zero_exit(exception):
   if (isinstance(exception, processes.CalledProcessError) and
@@ -96,7 +116,16 @@ class Stager(object):
   staging location.
   Implementation of this stager has to implement :func:`stage_artifact` and
   :func:`commit_manifest`.
+
+  Artifacts are staged one at a time unless an implementation sets
+  MAX_CONCURRENT_STAGING above 1, in which case its :func:`stage_artifact` must
+  be safe to call from multiple threads. Artifacts that share a staged name are
+  still staged one after another, in the order given.
   """
+
+  # Maximum number of artifacts staged concurrently by stage_job_resources.
+  MAX_CONCURRENT_STAGING = 1
+
   def stage_artifact(self, local_path_to_artifact, artifact_name):
     # type: (str, str) -> None
 
@@ -164,14 +193,13 @@ class Stager(object):
           setup_options.requirements_cache)
       # Populate cache with packages from requirements and stage the files
       # in the cache.
-      if not os.path.exists(requirements_cache_path):
-        os.makedirs(requirements_cache_path)
+      Stager._makedirs(requirements_cache_path)
       (
           populate_requirements_cache if populate_requirements_cache else
           Stager._populate_requirements_cache)(
               setup_options.requirements_file, requirements_cache_path)
-      for pkg in glob.glob(os.path.join(requirements_cache_path, '*')):
-        resources.append((pkg, os.path.basename(pkg)))
+      for pkg, pkg_name in Stager._list_files(requirements_cache_path):
+        resources.append((pkg, pkg_name))
 
     # Handle a setup file if present.
     # We will build the setup package locally and then copy it to the staging
@@ -299,13 +327,37 @@ class Stager(object):
     if staging_location is None:
       raise RuntimeError('The staging_location must be specified.')
 
-    staged_resources = []
-    for file_path, staged_path in resources:
-      self.stage_artifact(
-          file_path, FileSystems.join(staging_location, staged_path))
-      staged_resources.append(staged_path)
-
-    return staged_resources
+    join = FileSystems.join
+    num_workers = min(self.MAX_CONCURRENT_STAGING, len(resources))
+    if num_workers <= 1:
+      for file_path, staged_path in resources:
+        self.stage_artifact(file_path, join(staging_location, staged_path))
+    else:
+      # Several environments may stage resources under the same name. Stage
+      # those one after another so that the last one wins, as it does when
+      # staging sequentially, and a name is never written by two threads.
+      file_paths_by_name = collections.OrderedDict()
+      for file_path, staged_path in resources:
+        file_paths_by_name.setdefault(staged_path, []).append(file_path)
+
+      def stage_artifacts(file_paths, artifact_name):
+        for file_path in file_paths:
+          self.stage_artifact(file_path, artifact_name)
+
+      num_workers = min(num_workers, len(file_paths_by_name))
+      with futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        staging_futures = []
+        for staged_path, file_paths in file_paths_by_name.items():
+          staging_futures.append(
+              executor.submit(
+                  stage_artifacts,
+                  file_paths,
+                  join(staging_location, staged_path)))
+      # Surface the first failure in the order the resources were given.
+      for staging_future in staging_futures:
+        staging_future.result()
+
+    return [staged_path for _, staged_path in resources]
 
   def create_and_stage_job_resources(
       self,
@@ -327,8 +379,9 @@ class Stager(object):
             setup package. Used only if options.setup_file is not None. Used
             only for testing.
           temp_dir: Temporary folder where the resource building can happen. If
-            None then a unique temp directory will be created. Used only for
-            testing.
+            None then a unique temp directory will be created and deleted once
+            the resources are staged. A folder provided by the caller is left
+            in place. Used only for testing.
           populate_requirements_cache: Callable for populating the requirements
             cache. Used only for testing.
           staging_location: Location to stage the file.
@@ -343,15 +396,20 @@ class Stager(object):
           RuntimeError: If files specified are not found or error encountered
           while trying to create the resources (e.g., build a setup package).
         """
-    temp_dir = temp_dir or tempfile.mkdtemp()
+    created_temp_dir = temp_dir is None
+    if created_temp_dir:
+      temp_dir = tempfile.mkdtemp()
 
-    resources = self.create_job_resources(
-        options, temp_dir, build_setup_args, populate_requirements_cache)
-
-    staged_resources = self.stage_job_resources(resources, staging_location)
+    try:
+      resources = self.create_job_resources(
+          options, temp_dir, build_setup_args, populate_requirements_cache)
 
-    # Delete all temp files created while staging job resources.
-    shutil.rmtree(temp_dir)
+      staged_resources = self.stage_job_resources(resources, staging_location)
+    finally:
+      if created_temp_dir:
+        # Delete all temp files created while staging job resources. Failing
+        # to clean up should not fail the job.
+        shutil.rmtree(temp_dir, ignore_errors=True)
     retrieval_token = self.commit_manifest()
     return retrieval_token, staged_resources
 
@@ -363,28 +421,125 @@ class Stager(object):
       # TODO(silviuc): We should cache downloads so we do not do it for every
       # job.
       try:
-        # We check if the file is actually there because wget returns a file
-        # even for a 404 response (file will contain the contents of the 404
-        # response).
         # TODO(angoenka): Extract and use the filename when downloading file.
-        response, content = get_new_http().request(from_url)
-        if int(response['status']) >= 400:
-          raise RuntimeError(
-              'Artifact not found at %s (response: %s)' % (from_url, response))
-        with open(to_path, 'w') as f:
-          f.write(content)
+        # The response is streamed to disk so that large artifacts are never
+        # held in memory as a whole.
+        url_opener = Stager._build_url_opener()
+        with closing(url_opener.open(
+            from_url, timeout=DEFAULT_HTTP_TIMEOUT_SECONDS)) as url_read:
+          with open(to_path, 'wb') as f:
+            shutil.copyfileobj(url_read, f, length=_DOWNLOAD_CHUNK_SIZE)
+      except HTTPError as e:
+        _LOGGER.info('Failed to download Artifact from %s', from_url)
+        raise RuntimeError(
+            'Artifact not found at %s (response: %s)' % (from_url, e))
       except Exception:
         _LOGGER.info('Failed to download Artifact from %s', from_url)
         raise
     else:
-      if not os.path.isdir(os.path.dirname(to_path)):
-        _LOGGER.info(
-            'Created folder (since we have not done yet, and any errors '
-            'will follow): %s ',
-            os.path.dirname(to_path))
-        os.mkdir(os.path.dirname(to_path))
+      Stager._makedirs(os.path.dirname(to_path))
       shutil.copyfile(from_url, to_path)
 
+  @staticmethod
+  def _build_url_opener():
+    """Builds a url opener that uses the same proxy as get_new_http.
+
+    The first of the http_proxy and https_proxy environment variables that is
+    set is used for both http and https urls. Without either, no proxy is used.
+    """
+    proxies = {}  # type: Dict[str, str]
+    for proxy_env_var in ['http_proxy', 'https_proxy']:
+      proxy_url = os.environ.get(proxy_env_var)
+      if proxy_url:
+        proxies = {'http': proxy_url, 'https': proxy_url}
+        break
+    return build_opener(ProxyHandler(proxies))
+
+  @staticmethod
+  def _makedirs(path):
+    # type: (str) -> None
+
+    """Creates a directory and its parents unless the directory exists."""
+    # Equivalent to os.makedirs(path, exist_ok=True), which Python 2 lacks.
+    try:
+      os.makedirs(path)
+    except OSError as e:
+      if e.errno != errno.EEXIST or not os.path.isdir(path):
+        raise
+
+  @staticmethod
+  def _copy_local_file(from_path, to_path):
+    # type: (str, str) -> None
+
+    """Copies a local file, hard linking it when both paths allow it.
+
+    A hard link makes staging to a local directory independent of the file
+    size. It is not possible across file systems, on some file systems and on
+    Windows with Python 2, in which case the file contents are copied.
+    """
+    link = getattr(os, 'link', None)
+    if os.path.exists(to_path):
+      if link is not None and os.path.samefile(from_path, to_path):
+        return
+      # to_path may be a hard link to a file staged earlier. Copying into it
+      # would overwrite that file as well, so it is replaced instead.
+      os.remove(to_path)
+    if link is not None:
+      try:
+        link(from_path, to_path)
+        return
+      except OSError:
+        pass
+    shutil.copyfile(from_path, to_path)
+
+  @staticmethod
+  def _list_files(directory):
+    # type: (str) -> List[Tuple[str, str]]
+
+    """Returns (path, name) pairs for the regular files in a local directory."""
+    if hasattr(os, 'scandir'):
+      # Directory entries carry the file type reported by the listing, which
+      # avoids a stat call per entry on most platforms.
+      return [(entry.path, entry.name) for entry in os.scandir(directory)
+              if entry.is_file()]
+    # Python 2 has no os.scandir.
+    paths = [(os.path.join(directory, name), name)
+             for name in os.listdir(directory)]
+    return [(path, name) for path, name in paths if os.path.isfile(path)]
+
+  @staticmethod
+  def _find_existing_files(paths):
+    # type: (List[str]) -> Set[str]
+
+    """Returns the subset of the given paths that are existing local files.
+
+    Paths sharing a parent directory are checked against a single listing of
+    that directory rather than with a stat call each.
+    """
+    paths_by_directory = collections.defaultdict(
+        list)  # type: DefaultDict[str, List[str]]
+    for path in paths:
+      paths_by_directory[os.path.dirname(path)].append(path)
+
+    existing_files = set()  # type: Set[str]
+    for directory, directory_paths in paths_by_directory.items():
+      if len(directory_paths) == 1 or not hasattr(os, 'scandir'):
+        existing_files.update(p for p in directory_paths if os.path.isfile(p))
+        continue
+      try:
+        file_names = set(
+            name for _, name in Stager._list_files(directory or os.curdir))
+      except OSError:
+        # Not a local directory, e.g. a remote location.
+        file_names = set()
+      for path in directory_paths:
+        # Listed names are compared exactly. On case-insensitive or unicode
+        # normalizing file systems a path may name a listed file differently,
+        # so paths without an exact match are checked with isfile.
+        if os.path.basename(path) in file_names or os.path.isfile(path):
+          existing_files.add(path)
+    return existing_files
+
   @staticmethod
   def _is_remote_path(path):
     return path.find('://') != -1
@@ -405,40 +560,15 @@ class Stager(object):
       RuntimeError: If files specified are not found or do not have expected
         name patterns.
     """
-    resources = []  # type: List[Tuple[str, str]]
-    staging_temp_dir = tempfile.mkdtemp(dir=temp_dir)
-    local_packages = []  # type: List[str]
-    for package in jar_packages:
-      if not os.path.basename(package).endswith('.jar'):
-        raise RuntimeError(
+    return Stager._create_local_packages(
+        jar_packages,
+        temp_dir,
+        suffixes=('.jar', ),
+        option_name='--experiment=\'jar_packages=\'',
+        invalid_name_message=(
             'The --experiment=\'jar_packages=\' option expects a full path '
-            'ending with ".jar" instead of %s' % package)
-
-      if not os.path.isfile(package):
-        if Stager._is_remote_path(package):
-          # Download remote package.
-          _LOGGER.info(
-              'Downloading jar package: %s locally before staging', package)
-          _, last_component = FileSystems.split(package)
-          local_file_path = FileSystems.join(staging_temp_dir, last_component)
-          Stager._download_file(package, local_file_path)
-        else:
-          raise RuntimeError(
-              'The file %s cannot be found. It was specified in the '
-              '--experiment=\'jar_packages=\' command line option.' % package)
-      else:
-        local_packages.append(package)
-
-    local_packages.extend([
-        FileSystems.join(staging_temp_dir, f)
-        for f in os.listdir(staging_temp_dir)
-    ])
-
-    for package in local_packages:
-      basename = os.path.basename(package)
-      resources.append((package, basename))
-
-    return resources
+            'ending with ".jar" instead of %s'),
+        package_kind='jar package')
 
   @staticmethod
   def _create_extra_packages(extra_packages, temp_dir):
@@ -462,18 +592,18 @@ class Stager(object):
         RuntimeError: If files specified are not found or do not have expected
           name patterns.
       """
-    resources = []  # type: List[Tuple[str, str]]
-    staging_temp_dir = tempfile.mkdtemp(dir=temp_dir)
-    local_packages = []  # type: List[str]
-    for package in extra_packages:
-      if not (os.path.basename(package).endswith('.tar') or
-              os.path.basename(package).endswith('.tar.gz') or
-              os.path.basename(package).endswith('.whl') or
-              os.path.basename(package).endswith('.zip')):
-        raise RuntimeError(
+    resources = Stager._create_local_packages(
+        extra_packages,
+        temp_dir,
+        suffixes=('.tar', '.tar.gz', '.whl', '.zip'),
+        option_name='--extra_packages',
+        invalid_name_message=(
             'The --extra_package option expects a full path ending with '
-            '".tar", ".tar.gz", ".whl" or ".zip" instead of %s' % package)
-      if os.path.basename(package).endswith('.whl'):
+            '".tar", ".tar.gz", ".whl" or ".zip" instead of %s'),
+        package_kind='extra package')
+
+    for package, (_, basename) in zip(extra_packages, resources):
+      if basename.endswith('.whl'):
         _LOGGER.warning(
             'The .whl package "%s" is provided in --extra_package. '
             'This functionality is not officially supported. Since wheel '
@@ -481,29 +611,6 @@ class Stager(object):
             'binary-compatible with the worker environment (e.g. Python 2.7 '
             'running on an x64 Linux host).' % package)
 
-      if not os.path.isfile(package):
-        if Stager._is_remote_path(package):
-          # Download remote package.
-          _LOGGER.info(
-              'Downloading extra package: %s locally before staging', package)
-          _, last_component = FileSystems.split(package)
-          local_file_path = FileSystems.join(staging_temp_dir, last_component)
-          Stager._download_file(package, local_file_path)
-        else:
-          raise RuntimeError(
-              'The file %s cannot be found. It was specified in the '
-              '--extra_packages command line option.' % package)
-      else:
-        local_packages.append(package)
-
-    local_packages.extend([
-        FileSystems.join(staging_temp_dir, f)
-        for f in os.listdir(staging_temp_dir)
-    ])
-
-    for package in local_packages:
-      basename = os.path.basename(package)
-      resources.append((package, basename))
     # Create a file containing the list of extra packages and stage it.
     # The file is important so that in the worker the packages are installed
     # exactly in the order specified. This approach will avoid extra PyPI
@@ -512,8 +619,8 @@ class Stager(object):
     # dependency on B by downloading the package from PyPI. If package B is
     # installed first this is avoided.
     with open(os.path.join(temp_dir, EXTRA_PACKAGES_FILE), 'wt') as f:
-      for package in local_packages:
-        f.write('%s\n' % os.path.basename(package))
+      for _, basename in resources:
+        f.write('%s\n' % basename)
     # Note that the caller of this function is responsible for deleting the
     # temporary folder where all temp files are created, including this one.
     resources.append(
@@ -521,15 +628,79 @@ class Stager(object):
 
     return resources
 
+  @staticmethod
+  def _create_local_packages(packages,  # type: List[str]
+                             temp_dir,  # type: str
+                             suffixes,  # type: Tuple[str, ...]
+                             option_name,  # type: str
+                             invalid_name_message,  # type: str
+                             package_kind  # type: str
+                            ):
+    # type: (...) -> List[Tuple[str, str]]
+
+    """Returns local paths for the given packages, downloading remote ones.
+
+      One tuple of local file path and file name (no path) is returned for each
+      package, in the order the packages were given.
+
+      Args:
+        packages: Ordered list of paths to packages to be staged. Only packages
+          on localfile system and GCS are supported.
+        temp_dir: Temporary folder where remote packages are downloaded to.
+        suffixes: Tuple of file name endings the packages must have.
+        option_name: Command line option the packages were specified with.
+        invalid_name_message: Error message for a package without any of the
+          expected endings, formatted with the package path.
+        package_kind: Kind of the packages, used in log messages.
+
+      Raises:
+        RuntimeError: If files specified are not found or do not have expected
+          name patterns.
+      """
+    # Created on the first remote package, so staging only local packages
+    # does not leave an empty folder behind.
+    staging_temp_dir = None  # type: Optional[str]
+    local_packages = []  # type: List[Tuple[str, str]]
+    existing_files = Stager._find_existing_files(packages)
+    join = FileSystems.join
+    for package in packages:
+      basename = os.path.basename(package)
+      if not basename.endswith(suffixes):
+        raise RuntimeError(invalid_name_message % package)
+
+      if package not in existing_files:
+        if Stager._is_remote_path(package):
+          # Download remote package.
+          _LOGGER.info(
+              'Downloading %s: %s locally before staging',
+              package_kind,
+              package)
+          if staging_temp_dir is None:
+            staging_temp_dir = tempfile.mkdtemp(dir=temp_dir)
+          local_file_path = join(staging_temp_dir, basename)
+          Stager._download_file(package, local_file_path)
+          local_packages.append((local_file_path, basename))
+        else:
+          raise RuntimeError(
+              'The file %s cannot be found. It was specified in the '
+              '%s command line option.' % (package, option_name))
+      else:
+        local_packages.append((package, basename))
+
+    return local_packages
+
   @staticmethod
   def _get_python_executable():
     # Allow overriding the python executable to use for downloading and
     # installing dependencies, otherwise use the python executable for
-    # the current process.
-    python_bin = os.environ.get('BEAM_PYTHON') or sys.executable
-    if not python_bin:
-      raise ValueError('Could not find Python executable.')
-    return python_bin
+    # the current process. The choice is made once per process.
+    global _PYTHON_EXECUTABLE
+    if _PYTHON_EXECUTABLE is None:
+      python_bin = os.environ.get('BEAM_PYTHON') or sys.executable
+      if not python_bin:
+        raise ValueError('Could not find Python executable.')
+      _PYTHON_EXECUTABLE = python_bin
+    return _PYTHON_EXECUTABLE
 
   @staticmethod
   @retry.with_exponential_backoff(
@@ -563,26 +734,24 @@ class Stager(object):
                            build_setup_args=None  # type: Optional[List[str]]
                           ):
     # type: (...) -> str
-    saved_current_directory = os.getcwd()
-    try:
-      os.chdir(os.path.dirname(setup_file))
-      if build_setup_args is None:
-        build_setup_args = [
-            Stager._get_python_executable(),
-            os.path.basename(setup_file),
-            'sdist',
-            '--dist-dir',
-            temp_dir
-        ]
-      _LOGGER.info('Executing command: %s', build_setup_args)
-      processes.check_output(build_setup_args)
-      output_files = glob.glob(os.path.join(temp_dir, '*.tar.gz'))
-      if not output_files:
-        raise RuntimeError(
-            'File %s not found.' % os.path.join(temp_dir, '*.tar.gz'))
-      return output_files[0]
-    finally:
-      os.chdir(saved_current_directory)
+    if build_setup_args is None:
+      build_setup_args = [
+          Stager._get_python_executable(),
+          os.path.basename(setup_file),
+          'sdist',
+          '--dist-dir',
+          temp_dir
+      ]
+    _LOGGER.info('Executing command: %s', build_setup_args)
+    # The build runs in the setup file's folder. The working directory is
+    # passed to the subprocess rather than changed for the whole process.
+    processes.check_output(
+        build_setup_args, cwd=os.path.dirname(setup_file) or None)
+    for path, name in Stager._list_files(temp_dir):
+      if name.endswith('.tar.gz'):
+        return path
+    raise RuntimeError(
+        'File %s not found.' % os.path.join(temp_dir, '*.tar.gz'))
 
   @staticmethod
   def _desired_sdk_filename_in_staging_location(sdk_location):
@@ -622,14 +791,11 @@ class Stager(object):
         RuntimeError: if staging was not successful.
       """
     if sdk_remote_location == 'pypi':
-      sdk_local_file = Stager._download_pypi_sdk_package(temp_dir)
-      sdk_sources_staged_name = Stager.\
-          _desired_sdk_filename_in_staging_location(sdk_local_file)
-      _LOGGER.info('Staging SDK sources from PyPI: %s', sdk_sources_staged_name)
-      staged_sdk_files = [(sdk_local_file, sdk_sources_staged_name)]
-      try:
-        # Stage binary distribution of the SDK, for now on a best-effort basis.
-        sdk_local_file = Stager._download_pypi_sdk_package(
+      # Each distribution needs its own pip invocation, so the binary
+      # distribution is downloaded while the sources are being fetched.
+      with futures.ThreadPoolExecutor(max_workers=1) as executor:
+        binary_download = executor.submit(
+            Stager._download_pypi_sdk_package,
             temp_dir,
             fetch_binary=True,
             language_version_tag='%d%d' %
@@ -638,17 +804,27 @@ class Stager(object):
                 sys.version_info[0],
                 sys.version_info[1],
                 'mu' if sys.version_info[0] < 3 else 'm'))
-        sdk_binary_staged_name = Stager.\
+        sdk_local_file = Stager._download_pypi_sdk_package(temp_dir)
+        sdk_sources_staged_name = Stager.\
             _desired_sdk_filename_in_staging_location(sdk_local_file)
         _LOGGER.info(
-            'Staging binary distribution of the SDK from PyPI: %s',
-            sdk_binary_staged_name)
-        staged_sdk_files.append((sdk_local_file, sdk_binary_staged_name))
-      except RuntimeError as e:
-        _LOGGER.warning(
-            'Failed to download requested binary distribution '
-            'of the SDK: %s',
-            repr(e))
+            'Staging SDK sources from PyPI: %s', sdk_sources_staged_name)
+        staged_sdk_files = [(sdk_local_file, sdk_sources_staged_name)]
+        try:
+          # Stage binary distribution of the SDK, for now on a best-effort
+          # basis.
+          sdk_local_file = binary_download.result()
+          sdk_binary_staged_name = Stager.\
+              _desired_sdk_filename_in_staging_location(sdk_local_file)
+          _LOGGER.info(
+              'Staging binary distribution of the SDK from PyPI: %s',
+              sdk_binary_staged_name)
+          staged_sdk_files.append((sdk_local_file, sdk_binary_staged_name))
+        except RuntimeError as e:
+          _LOGGER.warning(
+              'Failed to download requested binary distribution '
+              'of the SDK: %s',
+              repr(e))
 
       return staged_sdk_files
     elif Stager._is_remote_path(sdk_remote_location):
@@ -663,6 +839,21 @@ class Stager(object):
           'The --sdk_location option was used with an unsupported '
           'type of location: %s' % sdk_remote_location)
 
+  @staticmethod
+  def _get_sdk_version(package_name):
+    # type: (str) -> str
+
+    """Returns the installed version of the given SDK distribution.
+
+      Raises:
+        pkg_resources.DistributionNotFound: if the distribution is not installed.
+      """
+    version = _SDK_VERSIONS.get(package_name)
+    if version is None:
+      version = pkg_resources.get_distribution(package_name).version
+      _SDK_VERSIONS[package_name] = version
+    return version
+
   @staticmethod
   def _download_pypi_sdk_package(
       temp_dir,
@@ -674,7 +865,7 @@ class Stager(object):
     """Downloads SDK package from PyPI and returns path to local path."""
     package_name = Stager.get_sdk_package_name()
     try:
-      version = pkg_resources.get_distribution(package_name).version
+      version = Stager._get_sdk_version(package_name)
     except pkg_resources.DistributionNotFound:
       raise RuntimeError(
           'Please set --sdk_location command-line option '
@@ -725,6 +916,13 @@ class Stager(object):
           os.path.join(temp_dir, '%s-%s.tar.gz' % (package_name, version))
       ]
 
+    # The folder may already hold the distribution, e.g. from a previous
+    # attempt, in which case there is no need to run pip.
+    for sdk_file in expected_files:
+      if os.path.exists(sdk_file):
+        _LOGGER.info('Using already downloaded SDK distribution %s', sdk_file)
+        return sdk_file
+
     _LOGGER.info('Executing command: %s', cmd_args)
     try:
       processes.check_output(cmd_args)
@@ -21,11 +21,13 @@
 
 from __future__ import absolute_import
 
+import io
 import logging
 import os
 import shutil
 import sys
 import tempfile
+import threading
 import unittest
 from typing import List
 
@@ -154,6 +156,48 @@ class StagerTest(unittest.TestCase):
     self.assertEqual(
         'The staging_location must be specified.', cm.exception.args[0])
 
+  def test_stage_job_resources_concurrently(self):
+    staging_dir = self.make_temp_dir()
+    source_dir = self.make_temp_dir()
+    resources = []
+    for i in range(10):
+      file_path = self.create_temp_file(
+          os.path.join(source_dir, 'file%d' % i), 'content%d' % i)
+      resources.append((file_path, 'staged%d' % i))
+
+    self.assertEqual(['staged%d' % i for i in range(10)],
+                     ConcurrentTestStager().stage_job_resources(
+                         resources, staging_location=staging_dir))
+    for i in range(10):
+      with open(os.path.join(staging_dir, 'staged%d' % i)) as f:
+        self.assertEqual('content%d' % i, f.read())
+
+  def test_stage_job_resources_concurrently_reraises_first_failure(self):
+    staging_dir = self.make_temp_dir()
+    source_dir = self.make_temp_dir()
+    file_path = self.create_temp_file(
+        os.path.join(source_dir, 'file'), 'nothing')
+    resources = [(file_path, 'staged'), ('first', 'first'),
+                 ('second', 'second'), (file_path, 'staged2')]
+    second_failed = threading.Event()
+
+    class FailingStager(ConcurrentTestStager):
+      def stage_artifact(self, local_path_to_artifact, artifact_name):
+        if local_path_to_artifact == 'first':
+          # Fails only after the resource that comes later has failed.
+          second_failed.wait(10)
+          raise IOError('first')
+        if local_path_to_artifact == 'second':
+          second_failed.set()
+          raise IOError('second')
+        super(FailingStager,
+              self).stage_artifact(local_path_to_artifact, artifact_name)
+
+    with self.assertRaises(IOError) as cm:
+      FailingStager().stage_job_resources(
+          resources, staging_location=staging_dir)
+    self.assertEqual('first', str(cm.exception))
+
   def test_no_main_session(self):
     staging_dir = self.make_temp_dir()
     options = PipelineOptions()
@@ -165,6 +209,16 @@ class StagerTest(unittest.TestCase):
                      self.stager.create_and_stage_job_resources(
                          options, staging_location=staging_dir)[1])
 
+  def test_temp_dir_provided_by_caller_is_kept(self):
+    staging_dir = self.make_temp_dir()
+    temp_dir = self.make_temp_dir()
+    options = PipelineOptions()
+    self.update_options(options)
+
+    self.stager.create_and_stage_job_resources(
+        options, temp_dir=temp_dir, staging_location=staging_dir)
+    self.assertTrue(os.path.isdir(temp_dir))
+
   # xdist adds unpicklable modules to the main session.
   @pytest.mark.no_xdist
   def test_with_main_session(self):
@@ -214,6 +268,27 @@ class StagerTest(unittest.TestCase):
     self.assertTrue(os.path.isfile(os.path.join(staging_dir, 'abc.txt')))
     self.assertTrue(os.path.isfile(os.path.join(staging_dir, 'def.txt')))
 
+  def test_with_requirements_cache_containing_directory(self):
+    staging_dir = self.make_temp_dir()
+    requirements_cache_dir = self.make_temp_dir()
+    source_dir = self.make_temp_dir()
+    os.mkdir(os.path.join(requirements_cache_dir, 'subdir'))
+
+    options = PipelineOptions()
+    self.update_options(options)
+    options.view_as(SetupOptions).requirements_cache = requirements_cache_dir
+    options.view_as(SetupOptions).requirements_file = os.path.join(
+        source_dir, stager.REQUIREMENTS_FILE)
+    self.create_temp_file(
+        os.path.join(source_dir, stager.REQUIREMENTS_FILE), 'nothing')
+    self.assertEqual(
+        sorted([stager.REQUIREMENTS_FILE, 'abc.txt', 'def.txt']),
+        sorted(
+            self.stager.create_and_stage_job_resources(
+                options,
+                populate_requirements_cache=self.populate_requirements_cache,
+                staging_location=staging_dir)[1]))
+
   def test_requirements_file_not_present(self):
     staging_dir = self.make_temp_dir()
     with self.assertRaises(RuntimeError) as cm:
@@ -287,6 +362,22 @@ class StagerTest(unittest.TestCase):
     self.assertTrue(
         os.path.isfile(os.path.join(staging_dir, stager.WORKFLOW_TARBALL_FILE)))
 
+  def test_build_setup_package_runs_in_setup_file_directory(self):
+    source_dir = self.make_temp_dir()
+    setup_file = self.create_temp_file(
+        os.path.join(source_dir, 'setup.py'), 'notused')
+    current_directory = os.getcwd()
+
+    # The fake build writes its output relative to the working directory.
+    tarball_file = stager.Stager._build_setup_package(
+        setup_file,
+        source_dir,
+        build_setup_args=[sys.executable, '-c', 'open("workflow.tar.gz", "a")'])
+
+    self.assertEqual(
+        os.path.join(source_dir, stager.WORKFLOW_TARBALL_FILE), tarball_file)
+    self.assertEqual(current_directory, os.getcwd())
+
   def test_setup_file_not_present(self):
     staging_dir = self.make_temp_dir()
 
@@ -358,6 +449,34 @@ class StagerTest(unittest.TestCase):
         with open(os.path.join(staging_dir, name)) as f:
           self.assertEqual(f.read(), 'Package content.')
 
+  def test_sdk_location_default_already_downloaded(self):
+    temp_dir = self.make_temp_dir()
+    sdk_file = self.create_temp_file(
+        os.path.join(temp_dir, 'apache-beam-2.0.0.zip'), 'Package content.')
+
+    with mock.patch.dict(stager._SDK_VERSIONS, {'apache-beam': '2.0.0'}):
+      with mock.patch('apache_beam.utils.processes.check_output') as pip:
+        self.assertEqual(
+            sdk_file, stager.Stager._download_pypi_sdk_package(temp_dir))
+    pip.assert_not_called()
+
+  def test_sdk_version_is_resolved_once(self):
+    with mock.patch.dict(stager._SDK_VERSIONS, clear=True):
+      with mock.patch('pkg_resources.get_distribution') as get_distribution:
+        get_distribution.return_value.version = '2.0.0'
+        self.assertEqual('2.0.0', stager.Stager._get_sdk_version('apache-beam'))
+        self.assertEqual('2.0.0', stager.Stager._get_sdk_version('apache-beam'))
+    get_distribution.assert_called_once_with('apache-beam')
+
+  def test_python_executable_is_resolved_once(self):
+    with mock.patch.object(stager, '_PYTHON_EXECUTABLE', None):
+      with mock.patch.dict(os.environ, {'BEAM_PYTHON': '/usr/bin/python-a'}):
+        self.assertEqual(
+            '/usr/bin/python-a', stager.Stager._get_python_executable())
+      with mock.patch.dict(os.environ, {'BEAM_PYTHON': '/usr/bin/python-b'}):
+        self.assertEqual(
+            '/usr/bin/python-a', stager.Stager._get_python_executable())
+
   def test_sdk_location_local_directory(self):
     staging_dir = self.make_temp_dir()
     sdk_location = self.make_temp_dir()
@@ -490,6 +609,38 @@ class StagerTest(unittest.TestCase):
     with open(tarball_path) as f:
       self.assertEqual(f.read(), 'Package content.')
 
+  def test_download_file_http_writes_binary_content(self):
+    to_path = os.path.join(self.make_temp_dir(), 'tarball.tar.gz')
+    content = b'\x1f\x8b\x08\x00\xff' * 100000
+
+    url_opener = mock.Mock()
+    url_opener.open.return_value = io.BytesIO(content)
+    with mock.patch('apache_beam.runners.portability.stager.Stager'
+                    '._build_url_opener',
+                    return_value=url_opener):
+      stager.Stager._download_file(
+          'https://storage.googleapis.com/my-bucket/tarball.tar.gz', to_path)
+
+    with open(to_path, 'rb') as f:
+      self.assertEqual(content, f.read())
+
+  def test_url_opener_uses_http_proxy_for_https(self):
+    proxy_env = {
+        'http_proxy': 'http://proxy.example.com:8080',
+        'https_proxy': 'http://other.example.com:8080'
+    }
+    with mock.patch.dict(os.environ, proxy_env):
+      url_opener = stager.Stager._build_url_opener()
+    proxy_handlers = [
+        handler for handler in url_opener.handlers
+        if isinstance(handler, stager.ProxyHandler)
+    ]
+    self.assertEqual(1, len(proxy_handlers))
+    self.assertEqual(
+        'http://proxy.example.com:8080', proxy_handlers[0].proxies['http'])
+    self.assertEqual(
+        'http://proxy.example.com:8080', proxy_handlers[0].proxies['https'])
+
   def test_with_extra_packages(self):
     staging_dir = self.make_temp_dir()
     source_dir = self.make_temp_dir()
@@ -540,6 +691,77 @@ class StagerTest(unittest.TestCase):
     self.assertEqual(['/tmp/remote/remote_file.tar.gz'],
                      self.remote_copied_files)
 
+  def test_makedirs(self):
+    path = os.path.join(self.make_temp_dir(), 'a', 'b')
+    stager.Stager._makedirs(path)
+    self.assertTrue(os.path.isdir(path))
+    # Creating an existing directory is a no-op.
+    stager.Stager._makedirs(path)
+    self.assertTrue(os.path.isdir(path))
+
+    file_path = self.create_temp_file(os.path.join(path, 'file'), 'nothing')
+    with self.assertRaises(OSError):
+      stager.Stager._makedirs(file_path)
+
+  def test_copy_local_file(self):
+    source_dir = self.make_temp_dir()
+    staging_dir = self.make_temp_dir()
+    from_path = self.create_temp_file(
+        os.path.join(source_dir, 'abc.tar.gz'), 'Package content.')
+    to_path = os.path.join(staging_dir, 'abc.tar.gz')
+
+    stager.Stager._copy_local_file(from_path, to_path)
+    # Staging the same file again is a no-op.
+    stager.Stager._copy_local_file(from_path, to_path)
+    with open(to_path) as f:
+      self.assertEqual('Package content.', f.read())
+
+    # A different file already at the destination is replaced.
+    other_path = self.create_temp_file(
+        os.path.join(source_dir, 'xyz.tar.gz'), 'Other content.')
+    stager.Stager._copy_local_file(other_path, to_path)
+    with open(to_path) as f:
+      self.assertEqual('Other content.', f.read())
+    # The file staged first, which to_path was linked to, is left unchanged.
+    with open(from_path) as f:
+      self.assertEqual('Package content.', f.read())
+
+  def test_find_existing_files(self):
+    source_dir = self.make_temp_dir()
+    other_dir = self.make_temp_dir()
+    abc = self.create_temp_file(os.path.join(source_dir, 'abc.jar'), 'nothing')
+    xyz = self.create_temp_file(os.path.join(source_dir, 'xyz.jar'), 'nothing')
+    ijk = self.create_temp_file(os.path.join(other_dir, 'ijk.jar'), 'nothing')
+    os.mkdir(os.path.join(source_dir, 'dir.jar'))
+
+    self.assertEqual({abc, xyz, ijk},
+                     stager.Stager._find_existing_files([
+                         abc,
+                         xyz,
+                         os.path.join(source_dir, 'missing.jar'),
+                         os.path.join(source_dir, 'dir.jar'),
+                         ijk,
+                         os.path.join(other_dir, 'missing.jar'),
+                         '/tmp/remote/remote.jar',
+                         'gs://my-bucket/a.jar',
+                         'gs://my-bucket/b.jar'
+                     ]))
+
+  def test_find_existing_files_with_differently_listed_names(self):
+    source_dir = self.make_temp_dir()
+    abc = self.create_temp_file(os.path.join(source_dir, 'abc.jar'), 'nothing')
+    xyz = self.create_temp_file(os.path.join(source_dir, 'xyz.jar'), 'nothing')
+
+    # Listing of a case-insensitive file system where the files were created
+    # with upper case names.
+    listing = [(os.path.join(source_dir, 'ABC.JAR'), 'ABC.JAR'),
+               (os.path.join(source_dir, 'XYZ.JAR'), 'XYZ.JAR')]
+    with mock.patch('apache_beam.runners.portability.stager.Stager._list_files',
+                    return_value=listing):
+      self.assertEqual({abc, xyz},
+                       stager.Stager._find_existing_files(
+                           [abc, xyz, os.path.join(source_dir, 'missing.jar')]))
+
   def test_with_extra_packages_missing_files(self):
     staging_dir = self.make_temp_dir()
     with self.assertRaises(RuntimeError) as cm:
@@ -637,6 +859,41 @@ class StagerTest(unittest.TestCase):
                              options, staging_location=staging_dir)[1])
     self.assertEqual(['/tmp/remote/remote.jar'], self.remote_copied_files)
 
+  def test_with_jar_packages_keeps_remote_package_order(self):
+    source_dir = self.make_temp_dir()
+    self.create_temp_file(os.path.join(source_dir, 'abc.jar'), 'nothing')
+    self.create_temp_file(os.path.join(source_dir, 'xyz.jar'), 'nothing')
+    jar_packages = [
+        os.path.join(source_dir, 'abc.jar'),
+        '/tmp/remote/remote.jar',
+        os.path.join(source_dir, 'xyz.jar')
+    ]
+
+    self.remote_copied_files = []
+
+    with mock.patch('apache_beam.runners.portability.stager_test'
+                    '.stager.Stager._download_file',
+                    staticmethod(self.file_copy)):
+      with mock.patch('apache_beam.runners.portability.stager_test'
+                      '.stager.Stager._is_remote_path',
+                      staticmethod(self.is_remote_path)):
+        resources = self.stager._create_jar_packages(
+            jar_packages, self.make_temp_dir())
+    self.assertEqual(['abc.jar', 'remote.jar', 'xyz.jar'],
+                     [name for _, name in resources])
+    self.assertTrue(os.path.isfile(resources[1][0]))
+
+  def test_with_local_jar_packages_creates_no_download_dir(self):
+    temp_dir = self.make_temp_dir()
+    source_dir = self.make_temp_dir()
+    self.create_temp_file(os.path.join(source_dir, 'abc.jar'), 'nothing')
+
+    resources = self.stager._create_jar_packages(
+        [os.path.join(source_dir, 'abc.jar')], temp_dir)
+    self.assertEqual([(os.path.join(source_dir, 'abc.jar'), 'abc.jar')],
+                     resources)
+    self.assertEqual([], os.listdir(temp_dir))
+
 
 class TestStager(stager.Stager):
   def stage_artifact(self, local_path_to_artifact, artifact_name):
@@ -648,6 +905,10 @@ class TestStager(stager.Stager):
     pass
 
 
+class ConcurrentTestStager(TestStager):
+  MAX_CONCURRENT_STAGING = 4
+
+
 if __name__ == '__main__':
   logging.getLogger().setLevel(logging.INFO)
   unittest.main()
@@ -19,60 +19,190 @@
 A script to pull licenses for Python.
 The script is executed within Docker.
 """
+import errno
+import functools
+import hashlib
 import json
 import logging
 import os
 import shutil
-import subprocess
 import sys
 import tempfile
-import traceback
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
 import yaml
+from piplicenses import create_output_string
+from piplicenses import create_parser
 
-from future.moves.urllib.request import urlopen
-from tenacity import retry
-from tenacity import stop_after_attempt
-from tenacity import wait_exponential
+# Use the libyaml based loader when PyYAML was built with it.
+try:
+  YAML_LOADER = yaml.CSafeLoader
+except AttributeError:
+  YAML_LOADER = yaml.SafeLoader
 
 LICENSE_DIR = '/opt/apache/beam/third_party_licenses'
+# Number of dependencies whose licenses are pulled at the same time. Pulling
+# is dominated by network round trips, so it is worth overlapping them.
+MAX_CONCURRENT_PULLS = 16
+# Shared by all pulls so that connections to the same host, e.g. github.com,
+# are kept alive and reused across dependencies.
+HTTP = urllib3.PoolManager(num_pools=32, maxsize=MAX_CONCURRENT_PULLS)
+FILE_URL_PREFIX = 'file://'
+# Large enough to read a typical license file with a single call.
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# Errors that downloading a license can hit and that are worth a retry. Any
+# other error is a bug and fails the pull right away.
+DOWNLOAD_ERRORS = (urllib3.exceptions.HTTPError, IOError, OSError)
+
+# Many dependencies ship the same license text. Files written to LICENSE_DIR
+# are hard linked to the first file with the same content, keyed by digest.
+_FILES_BY_DIGEST = {}
+_FILES_BY_DIGEST_LOCK = threading.Lock()
+
+
+def retry(attempts, retry_on=Exception, initial_delay_secs=0):
+  '''
+  :param attempts: number of times to call the function before giving up
+  :param retry_on: exception types that are retried
+  :param initial_delay_secs: wait before the first retry, doubled afterwards
+  :return: a decorator that retries the function and reraises the last error
+  '''
+  def decorator(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      delay_secs = initial_delay_secs
+      for attempt in range(1, attempts + 1):
+        try:
+          return fn(*args, **kwargs)
+        except retry_on:
+          if attempt == attempts:
+            raise
+          time.sleep(delay_secs)
+          delay_secs *= 2
+
+    return wrapper
+
+  return decorator
+
+
+def download_file(url, dest_path):
+  if url.startswith(FILE_URL_PREFIX):
+    # Licenses under manual_licenses/ are configured as local file urls.
+    shutil.copy(url[len(FILE_URL_PREFIX):], dest_path)
+    return
+  response = HTTP.request('GET', url, preload_content=False)
+  try:
+    if response.status != 200:
+      raise urllib3.exceptions.HTTPError(
+          'Failed to download {url}, status: {status}'.format(
+              url=url, status=response.status))
+    with open(dest_path, 'wb') as dest:
+      shutil.copyfileobj(response, dest, DOWNLOAD_CHUNK_SIZE)
+  finally:
+    response.release_conn()
+
+
+def new_temp_path(path):
+  '''
+  :param path: a file that is about to be replaced
+  :return: an unused path next to it, to be renamed over the file
+
+  An existing file may be a hard link to another license, so it is replaced by
+  a rename rather than written through.
+  '''
+  temp_path = path + '.tmp'
+  if os.path.lexists(temp_path):
+    # Left behind by a failed earlier attempt.
+    os.remove(temp_path)
+  return temp_path
+
 
+def link_or_copy(source_path, dest_path):
+  # License files of installed packages are usually on the same file system
+  # as LICENSE_DIR, so a hard link avoids copying their content.
+  if os.path.exists(dest_path) and os.path.samefile(source_path, dest_path):
+    # Linked by an earlier attempt. Renaming a link to the same file over it
+    # would do nothing and leave the temp file behind.
+    return
+  temp_path = new_temp_path(dest_path)
+  try:
+    os.link(source_path, temp_path)
+    copied = False
+  except OSError:
+    shutil.copy(source_path, temp_path)
+    copied = True
+  os.rename(temp_path, dest_path)
+  if copied:
+    dedupe_file(dest_path)
 
-def run_bash_command(command):
-  return subprocess.check_output(command.split()).decode('utf-8')
+
+def dedupe_file(path):
+  # path is already in place, so failing to dedupe it only costs disk space.
+  try:
+    with open(path, 'rb') as f:
+      digest = hashlib.sha256(f.read()).hexdigest()
+    with _FILES_BY_DIGEST_LOCK:
+      first_path = _FILES_BY_DIGEST.setdefault(digest, path)
+    if first_path != path and not os.path.samefile(first_path, path):
+      temp_path = new_temp_path(path)
+      os.link(first_path, temp_path)
+      os.rename(temp_path, path)
+  except (IOError, OSError):
+    logging.warning('Failed to dedupe {path}.'.format(path=path), exc_info=True)
 
 
 def run_pip_licenses():
-  command = 'pip-licenses --with-license-file --format=json'
-  dependencies = run_bash_command(command)
-  return json.loads(dependencies)
+  # Call pip-licenses in this process rather than through its command line
+  # entry point, which would start another Python interpreter.
+  args = create_parser().parse_args(['--with-license-file', '--format=json'])
+  # Only keep the fields used here, so that the license texts in the output
+  # are freed before the licenses are pulled.
+  dependencies = []
+  for dep in json.loads(create_output_string(args)):
+    dependencies.append({
+        'Name': dep['Name'], 'LicenseFile': dep['LicenseFile']
+    })
+  return dependencies
 
 
-@retry(stop=stop_after_attempt(3))
+@retry(attempts=3, retry_on=(IOError, OSError))
 def copy_license_files(dep):
   source_license_file = dep['LicenseFile']
-  if source_license_file.lower() == 'unknown':
-    return False
   name = dep['Name'].lower()
-  dest_dir = '/'.join([LICENSE_DIR, name])
+  dest_dir = os.path.join(LICENSE_DIR, name)
+  dest_file = os.path.join(dest_dir, 'LICENSE')
   try:
-    os.mkdir(dest_dir)
-    shutil.copy(source_license_file, dest_dir + '/LICENSE')
+    try:
+      os.mkdir(dest_dir)
+    except OSError as e:
+      # The directory is left from an earlier attempt.
+      if e.errno != errno.EEXIST:
+        raise
+    link_or_copy(source_license_file, dest_file)
     logging.debug(
         'Successfully pulled license for {dep} with pip-licenses.'.format(
             dep=name))
     return True
-  except Exception as e:
-    logging.error(
+  except (IOError, OSError) as e:
+    if e.errno == errno.ENOENT and e.filename == source_license_file:
+      # Retrying does not help when pip-licenses reported a missing file.
+      # The license is then pulled from URLs instead, which is reported if it
+      # fails too.
+      logging.warning(
+          'License file {source} of {dep} does not exist.'.format(
+              source=source_license_file, dep=name))
+      return False
+    # logging.exception keeps the traceback of one worker thread together.
+    logging.exception(
         'Failed to copy from {source} to {dest}'.format(
-            source=source_license_file, dest=dest_dir + '/LICENSE'))
-    traceback.print_exc()
+            source=source_license_file, dest=dest_file))
     raise
 
 
-@retry(
-    reraise=True,
-    wait=wait_exponential(multiplier=2),
-    stop=stop_after_attempt(5))
+@retry(attempts=5, retry_on=DOWNLOAD_ERRORS, initial_delay_secs=2)
 def pull_from_url(dep, configs):
   '''
   :param dep: name of a dependency
@@ -80,57 +210,84 @@ def pull_from_url(dep, configs):
   :return: boolean
 
   It downloads files form urls to a temp directory first in order to avoid
-  to deal with any temp files. It helps keep clean final directory.
+  to deal with any temp files. It helps keep clean final directory. The temp
+  directory is created under LICENSE_DIR, so that it can be renamed to the
+  final directory instead of being copied.
   '''
-  if dep in configs:
-    config = configs[dep]
-    dest_dir = '/'.join([LICENSE_DIR, dep])
-    cur_temp_dir = tempfile.mkdtemp()
+  config = configs.get(dep)
+  if config is None:
+    return False
+  if config['license'] == 'skip':
+    logging.info('Skip pulling license for {dep}.'.format(dep=dep))
+    return True
+
+  dest_dir = os.path.join(LICENSE_DIR, dep)
+  cur_temp_dir = tempfile.mkdtemp(dir=LICENSE_DIR, prefix='.tmp_' + dep + '_')
+
+  try:
+    download_file(config['license'], os.path.join(cur_temp_dir, 'LICENSE'))
+    logging.debug(
+        'Successfully pulled license for {dep} from {url}.'.format(
+            dep=dep, url=config['license']))
+
+    # notice is optional.
+    if 'notice' in config:
+      download_file(config['notice'], os.path.join(cur_temp_dir, 'NOTICE'))
+
+    os.rename(cur_temp_dir, dest_dir)
+  except DOWNLOAD_ERRORS:
+    logging.exception(
+        'Error occurred when pull license for {dep} from {url}.'.format(
+            dep=dep, url=config))
+    raise
+  finally:
+    # Only left behind when pulling failed.
+    shutil.rmtree(cur_temp_dir, ignore_errors=True)
+
+  for file_name in os.listdir(dest_dir):
+    dedupe_file(os.path.join(dest_dir, file_name))
+  return True
+
+
+def pull_license(dep, configs):
+  '''
+  :param dep: a dependency entry from pip-licenses
+  :param configs: a dict from dep_urls_py.yaml
+  :return: a tuple of the dependency name and whether its license was pulled
+
+  The license file found by pip-licenses tool is used when there is one and it
+  can be copied, otherwise the license is pulled from URLs.
+  '''
+  name = dep['Name'].lower()
+  if dep['LicenseFile'].lower() != 'unknown' and copy_license_files(dep):
+    return name, True
+  return name, pull_from_url(name, configs)
 
-    try:
-      if config['license'] == 'skip':
-        print('Skip pulling license for ', dep)
-      else:
-        url_read = urlopen(config['license'])
-        with open(cur_temp_dir + '/LICENSE', 'wb') as temp_write:
-          shutil.copyfileobj(url_read, temp_write)
-        logging.debug(
-            'Successfully pulled license for {dep} from {url}.'.format(
-                dep=dep, url=config['license']))
-
-      # notice is optional.
-      if 'notice' in config:
-        url_read = urlopen(config['notice'])
-        with open(cur_temp_dir + '/NOTICE', 'wb') as temp_write:
-          shutil.copyfileobj(url_read, temp_write)
-
-      shutil.copytree(cur_temp_dir, dest_dir)
-      return True
-    except Exception as e:
-      logging.error(
-          'Error occurred when pull license for {dep} from {url}.'.format(
-              dep=dep, url=config))
-      traceback.print_exc()
-      raise
-    finally:
-      shutil.rmtree(cur_temp_dir)
 
 if __name__ == "__main__":
   os.makedirs(LICENSE_DIR)
   no_licenses = []
-  logging.getLogger().setLevel(logging.INFO)
+  # Log records from worker threads are written whole, one line each.
+  logging.basicConfig(level=logging.INFO, format='%(message)s')
 
   with open('/tmp/license_scripts/dep_urls_py.yaml') as file:
-    dep_config = yaml.full_load(file)
+    dep_config = yaml.load(file, Loader=YAML_LOADER)
+  # dependency names from pip-licenses are matched in lower case.
+  pip_dependencies = {
+      name.lower(): config
+      for name, config in dep_config['pip_dependencies'].items()
+  }
 
   dependencies = run_pip_licenses()
   # add licenses for pip installed packages.
-  # try to pull licenses with pip-licenses tool first, if no license pulled,
-  # then pull from URLs.
-  for dep in dependencies:
-    if not (copy_license_files(dep) or
-            pull_from_url(dep['Name'].lower(), dep_config['pip_dependencies'])):
-      no_licenses.append(dep['Name'].lower())
+  with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PULLS) as executor:
+    results = list(
+        executor.map(
+            lambda dep: pull_license(dep, pip_dependencies),
+            dependencies))
+  for name, pulled in results:
+    if not pulled:
+      no_licenses.append(name)
 
   if no_licenses:
     py_ver = '%d.%d' % (sys.version_info[0], sys.version_info[1])